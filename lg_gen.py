@@ -1,10 +1,22 @@
-import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 import sys
-import time
 import base64
 import zlib
+import re
+from datetime import datetime, timezone
+from functools import lru_cache
+from collections import namedtuple
+from xml.sax.saxutils import escape, quoteattr
+
+try:
+    # orjson decodes the (large) schedule payload several times faster;
+    # both raise ValueError subclasses on bad input.
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 # Configuration
 API_URL = 'https://api.lgchannels.com/api/v1.0/schedulelist'
@@ -32,51 +44,132 @@ headers = {
 MAX_RETRIES = 3
 RETRY_BACKOFF_SECONDS = 5
 
+# Cap on a server-sent Retry-After so a throttled API can't stall the job
+MAX_RETRY_AFTER_SECONDS = 60
+
+class LinearRetry(Retry):
+    """urllib3 Retry with the original linear backoff and per-attempt logging."""
+
+    def get_backoff_time(self):
+        # 5s before the first retry, 10s before the second, ...
+        return RETRY_BACKOFF_SECONDS * len(self.history)
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, MAX_RETRY_AFTER_SECONDS)
+
+    def increment(self, method=None, url=None, response=None, error=None, *args, **kwargs):
+        # Log enough to actually diagnose a failed attempt, since the
+        # adapter retries before fetch_data() ever sees a response
+        attempt = len(self.history) + 1
+        if response is not None:
+            print(f"Attempt {attempt}: HTTP {response.status}, "
+                  f"content-type={response.headers.get('content-type')}")
+        else:
+            print(f"Attempt {attempt}: request exception: {error}")
+        return super().increment(method, url, response, error, *args, **kwargs)
+
+# One keep-alive session for the whole run; retries and backoff are handled
+# by urllib3 inside the adapter instead of a hand-rolled loop.
+SESSION = requests.Session()
+SESSION.headers.update(headers)
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=1,
+    max_retries=LinearRetry(
+        # MAX_RETRIES counts attempts; urllib3 counts retries after the first
+        total=MAX_RETRIES - 1,
+        # 403 included: the CDN in front of the API sometimes refuses a
+        # request that succeeds moments later
+        status_forcelist=(403, 429, 500, 502, 503, 504),
+        raise_on_status=False,
+    ),
+))
+
 def fetch_data():
-    last_error = None
-    for attempt in range(1, MAX_RETRIES + 1):
+    try:
+        response = SESSION.get(API_URL, timeout=30)
+    except requests.RequestException as e:
+        print(f"Error fetching data: {e}")
+        return None
+
+    # Log enough to actually diagnose a failure instead of guessing
+    print(f"HTTP {response.status_code}, "
+          f"content-type={response.headers.get('content-type')}, "
+          f"body-length={len(response.content)}")
+
+    if response.status_code != 200:
+        print(f"Non-200 response body (first 300 chars): {response.text[:300]!r}")
+        print(f"Error fetching data: HTTP {response.status_code}")
+        return None
+
+    try:
+        return json_loads(response.content)
+    except ValueError:
+        # API sometimes (now, apparently always) returns the payload
+        # as base64(zlib(json)) with content-type: text/plain instead
+        # of raw JSON. Try that before giving up.
         try:
-            response = requests.get(API_URL, headers=headers, timeout=30)
-            # Log enough to actually diagnose a failure instead of guessing
-            print(f"Attempt {attempt}: HTTP {response.status_code}, "
-                  f"content-type={response.headers.get('content-type')}, "
-                  f"body-length={len(response.content)}")
-
-            if response.status_code != 200:
-                print(f"Non-200 response body (first 300 chars): {response.text[:300]!r}")
-                last_error = f"HTTP {response.status_code}"
-            else:
-                try:
-                    return response.json()
-                except json.JSONDecodeError:
-                    # API sometimes (now, apparently always) returns the payload
-                    # as base64(zlib(json)) with content-type: text/plain instead
-                    # of raw JSON. Try that before giving up.
-                    try:
-                        decompressed = zlib.decompress(base64.b64decode(response.text))
-                        return json.loads(decompressed)
-                    except Exception as e:
-                        print(f"Body wasn't raw JSON or base64+zlib JSON either "
-                              f"(first 300 chars): {response.text[:300]!r}")
-                        last_error = e
-        except requests.RequestException as e:
-            print(f"Request exception on attempt {attempt}: {e}")
-            last_error = e
-
-        if attempt < MAX_RETRIES:
-            sleep_for = RETRY_BACKOFF_SECONDS * attempt
-            print(f"Retrying in {sleep_for}s...")
-            time.sleep(sleep_for)
-
-    print(f"Error fetching data after {MAX_RETRIES} attempts: {last_error}")
-    return None
-
-def generate_files(data):
-    if not data or 'categories' not in data:
-        return
-
-    m3u_lines = [f'#EXTM3U x-tvg-url="{GITHUB_RAW_URL}"']
-    xml_lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<tv>']
+            decompressed = zlib.decompress(base64.b64decode(response.text))
+            return json_loads(decompressed)
+        except Exception as e:
+            print(f"Body wasn't raw JSON or base64+zlib JSON either "
+                  f"(first 300 chars): {response.text[:300]!r}")
+            print(f"Error fetching data: {e}")
+            return None
+
+# API timestamps are almost always UTC with a trailing 'Z', e.g.
+# 2026-08-08T14:00:00Z or 2026-08-08T14:00:00.000Z
+ISO_UTC_RE = re.compile(r'^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.\d+)?Z$')
+
+@lru_cache(maxsize=16384)
+def format_time(value):
+    """Convert an API ISO 8601 timestamp to XMLTV format, or '' if unparseable."""
+    match = ISO_UTC_RE.match(value)
+    if match:
+        return ''.join(match.groups()) + ' +0000'
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return ''
+    if parsed.tzinfo is None:
+        # No offset given: treat as UTC like the rest of the feed
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.strftime('%Y%m%d%H%M%S %z')
+
+@lru_cache(maxsize=8192)
+def escape_text(text):
+    """XML-escape a text node; reruns repeat the same titles/descriptions."""
+    return escape(str(text))
+
+# Compact per-channel record shared by the M3U and EPG writers
+Channel = namedtuple('Channel', ['id', 'name', 'logo', 'group', 'stream_url', 'programs'])
+
+def write_atomic(outputs):
+    """Write each (filename, parts) to a temp file beside it, then swap them all in.
+
+    Nothing is replaced until every temp file has been written, so a failed
+    write leaves all the previous files in place.
+    """
+    tmp_paths = []
+    try:
+        for filename, parts in outputs:
+            tmp_path = filename + '.tmp'
+            tmp_paths.append(tmp_path)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.writelines(parts)
+    except BaseException:
+        for tmp_path in tmp_paths:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+    for filename, _ in outputs:
+        os.replace(filename + '.tmp', filename)
+
+def get_channels(data):
+    """Flatten the category listing into unique, streamable Channel records."""
+    channels = []
     processed_channels = set()
 
     for category in data.get('categories', []):
@@ -85,40 +178,74 @@ def generate_files(data):
             chan_id = chan.get('channelId', '')
             if not chan_id or chan_id in processed_channels:
                 continue
-            
+
             chan_name = chan.get('channelName', 'Unknown')
             stream_url = chan.get('mediaStaticUrl', '').split('?')[0]
             if not stream_url: continue
 
-            logo = chan['programs'][0].get('imageUrl', '') if chan.get('programs') else ""
-            m3u_lines.append(f'#EXTINF:-1 tvg-id="{chan_id}" tvg-name="{chan_name}" tvg-logo="{logo}" group-title="{cat_name}",{chan_name}')
-            m3u_lines.append(stream_url)
-
-            xml_lines.append(f'  <channel id="{chan_id}">\n    <display-name>{chan_name}</display-name>\n  </channel>')
-            for prog in chan.get('programs', []):
-                start = prog.get('startDateTime', '').replace('-', '').replace(':', '').replace('T', '').replace('Z', ' +0000')
-                end = prog.get('endDateTime', '').replace('-', '').replace(':', '').replace('T', '').replace('Z', ' +0000')
-                title = prog.get('programTitle', 'No Title').replace('&', '&amp;')
-                # Fixed AttributeError: 'NoneType' object has no attribute 'replace' [cite: 15]
-                desc = (prog.get('description') or '').replace('&', '&amp;')
-                if start and end:
-                    xml_lines.append(f'  <programme start="{start}" stop="{end}" channel="{chan_id}">')
-                    xml_lines.append(f'    <title>{title}</title>\n    <desc>{desc}</desc>\n  </programme>')
-
+            programs = chan.get('programs') or []
+            logo = programs[0].get('imageUrl', '') if programs else ""
+            channels.append(Channel(chan_id, chan_name, logo, cat_name, stream_url, programs))
             processed_channels.add(chan_id)
 
-    xml_lines.append('</tv>')
+    return channels
+
+def generate_m3u_playlist(channels):
+    m3u_lines = [f'#EXTM3U x-tvg-url="{GITHUB_RAW_URL}"\n']
+    for c in channels:
+        # One formatted entry per channel: EXTINF line plus stream URL
+        m3u_lines.append(f'#EXTINF:-1 tvg-id="{c.id}" tvg-name="{c.name}" tvg-logo="{c.logo}" group-title="{c.group}",{c.name}\n{c.stream_url}\n')
+    return m3u_lines
+
+def generate_epg_xml(channels):
+    # Local aliases: the programme loop below runs once per listing, and
+    # locals are cheaper than repeated global/attribute lookups.
+    fmt = format_time
+    esc = escape_text
+
+    xml_lines = ['<?xml version="1.0" encoding="UTF-8"?>\n<tv>\n']
+    append = xml_lines.append
+
+    for c in channels:
+        # quoteattr() escapes and adds the surrounding quotes
+        chan_id = quoteattr(str(c.id))
+        append(f'  <channel id={chan_id}>\n    <display-name>{escape(str(c.name))}</display-name>\n  </channel>\n')
+        for prog in c.programs:
+            # Adjacent programmes share boundaries, so most of these hit the cache
+            start = fmt(prog.get('startDateTime') or '')
+            end = fmt(prog.get('endDateTime') or '')
+            if start and end:
+                title = esc(prog.get('programTitle') or 'No Title')
+                desc = esc(prog.get('description') or '')
+                append(f'  <programme start="{start}" stop="{end}" channel={chan_id}>\n'
+                       f'    <title>{title}</title>\n    <desc>{desc}</desc>\n  </programme>\n')
+
+    append('</tv>')
+    return xml_lines
+
+def generate_files(data):
+    if not data or 'categories' not in data:
+        return
 
-    with open(M3U_FILENAME, "w", encoding="utf-8") as f:
-        f.write("\n".join(m3u_lines))
-    with open(EPG_FILENAME, "w", encoding="utf-8") as f:
-        f.write("\n".join(xml_lines))
+    # Build both outputs before touching either file, then swap them in
+    # together so the playlist and EPG stay in step.
+    channels = get_channels(data)
+    m3u_lines = generate_m3u_playlist(channels)
+    xml_lines = generate_epg_xml(channels)
+
+    write_atomic([(M3U_FILENAME, m3u_lines), (EPG_FILENAME, xml_lines)])
+
+def main():
+    try:
+        fetched = fetch_data()
+        if fetched is None:
+            # Don't let this look like a successful run in the Actions UI -
+            # a green check here previously masked stale playlists/EPG.
+            print("Aborting: no data fetched, leaving existing files untouched.")
+            sys.exit(1)
+        generate_files(fetched)
+    finally:
+        SESSION.close()
 
 if __name__ == "__main__":
-    fetched = fetch_data()
-    if fetched is None:
-        # Don't let this look like a successful run in the Actions UI -
-        # a green check here previously masked stale playlists/EPG.
-        print("Aborting: no data fetched, leaving existing files untouched.")
-        sys.exit(1)
-    generate_files(fetched)
+    main()